@@ -0,0 +1,220 @@
+"""Offline benchmarks for the Room Manager command paths.
+
+Runs the RoomManager handlers against the fake homeserver from fake_homeserver.py and reports
+latency percentiles, homeserver requests and received bytes per run for every scenario.
+
+    python benchmarks/bench_roommanager.py --rooms 1000 --members 50 --latency 0.005
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+from aiohttp import ClientSession
+from ruamel.yaml import YAML
+from maubot.matrix import MaubotMatrixClient, MaubotMessageEvent
+from mautrix.api import HTTPAPI
+from mautrix.types import EventID, EventType, MessageEvent, MessageType, RoomID, TextMessageEventContent, UserID
+from mautrix.util.async_db import Database
+from mautrix.util.config import RecursiveDict
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from roommanager import Config, RoomManager, ROOM_VERSION, EVENT_TYPE_ROOM_CHANGE
+from fake_homeserver import FakeHomeserver
+
+BOT = UserID("@roommanager:bench.local")
+ADMIN = UserID("@admin:bench.local")
+SCENARIOS = ["backfillrooms", "listrooms", "addadmin", "upgraderoom", "forgetroom", "log_event", "janitor"]
+LOG_EVENTS_PER_RUN = 100
+
+class Bench:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.server = FakeHomeserver(BOT, latency=args.latency, jitter=args.jitter)
+        self.members = [UserID(f"@user{i}:bench.local") for i in range(args.members)]
+        self.owned_rooms: list[str] = []
+        self.command_room = ""
+        self.log_room = ""
+        self.results: dict[str, dict] = {}
+
+    def populate(self) -> None:
+        """Creates the command and logging rooms, then N rooms of which half are owned by the bot."""
+        self.command_room = self.server.add_room(ADMIN, members=[])
+        self.log_room = self.server.add_room(BOT, name="Log")
+        for i in range(self.args.rooms):
+            creator = BOT if i % 2 == 0 else ADMIN
+            # The admin is a joined member everywhere, so !addadmin passes the room admin check
+            room_id = self.server.add_room(creator, name=f"Room {i}", members=[*self.members, ADMIN], admins=[ADMIN], join_rule="public" if i % 4 == 0 else "invite")
+            if creator == BOT:
+                self.owned_rooms.append(room_id)
+
+    async def setup(self, tmp: str) -> None:
+        self.populate()
+        await self.server.start()
+        self.http = ClientSession()
+        client = MaubotMatrixClient(mxid=BOT, api=HTTPAPI(base_url=self.server.url, token="bench", client_session=self.http))
+        base = RecursiveDict(YAML().load(open(ROOT / "base-config.yaml")), dict)
+        overrides = {
+            "administrators": [ADMIN],
+            "logging_channel": self.log_room,
+            # Flushing is triggered explicitly by the log_event scenario
+            "logging_flush_interval": 3600,
+            "logging_batch_size": self.args.log_batch_size,
+            "max_parallel_requests": self.args.max_parallel,
+            # The janitor scenario only reports which rooms it would forget, so every run checks the same rooms
+            "janitor_max_age": 30,
+            "janitor_action": "forget",
+            "janitor_dry_run": True
+        }
+        config = Config(load=lambda: overrides, load_base=lambda: base, save=lambda c: None)
+        self.database = Database.create(f"sqlite:{tmp}/bench.db", upgrade_table=RoomManager.get_db_upgrade_table(), log=logging.getLogger("db"))
+        await self.database.start()
+        self.plugin = RoomManager(client=client, loop=asyncio.get_running_loop(), http=self.http, instance_id="bench",
+                                  log=logging.getLogger("roommanager"), config=config, database=self.database,
+                                  webapp=None, webapp_url=None, loader=None)
+        await self.plugin.internal_start()
+        await self.plugin.room_index_task
+        # The registry starts empty, so every scenario also works when it runs on its own
+        await self.command("backfillrooms")
+
+    async def teardown(self) -> None:
+        await self.plugin.internal_stop()
+        await self.database.stop()
+        await self.http.close()
+        await self.server.stop()
+
+    def message(self, body: str) -> MaubotMessageEvent:
+        evt = MessageEvent(type=EventType.ROOM_MESSAGE, room_id=RoomID(self.command_room), event_id=EventID("$bench"),
+                           sender=ADMIN, timestamp=0, content=TextMessageEventContent(msgtype=MessageType.TEXT, body=body))
+        return MaubotMessageEvent(evt, self.plugin.client)
+
+    async def command(self, name: str, *args: str) -> None:
+        await getattr(self.plugin, name)(self.message(" ".join([f"!{name}", *args])))
+
+    async def measure(self, name: str, run, prepare=None) -> None:
+        """Runs a scenario repeat times and records its latency, homeserver requests and received bytes."""
+        latencies, requests, received = [], [], []
+        for i in range(self.args.repeat):
+            argument = prepare(i) if prepare else None
+            stats = self.plugin.operation_stats
+            bytes_before = sum(s.bytes_received for s in stats.values())
+            requests_before = sum(self.server.request_counts.values())
+            start = time.perf_counter()
+            await run(argument)
+            latencies.append(time.perf_counter() - start)
+            requests.append(sum(self.server.request_counts.values()) - requests_before)
+            received.append(sum(s.bytes_received for s in stats.values()) - bytes_before)
+        latencies.sort()
+        self.results[name] = {
+            "runs": len(latencies),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "requests_per_run": sum(requests) / len(requests),
+            "kib_per_run": sum(received) / len(received) / 1024
+        }
+
+    async def bench_backfillrooms(self) -> None:
+        # Every run starts from an empty registry and state cache, so each one scans all joined rooms
+        async def run(_):
+            self.plugin.owned_rooms.clear()
+            self.plugin.state_cache.entries.clear()
+            await self.command("backfillrooms")
+        await self.measure("backfillrooms", run)
+
+    async def bench_listrooms(self) -> None:
+        await self.measure("listrooms", lambda _: self.command("listrooms", "public"))
+
+    async def bench_addadmin(self) -> None:
+        rooms = self.owned_rooms
+        def prepare(i: int) -> tuple[str, str]:
+            return f"@newadmin{i}:bench.local", rooms[i % len(rooms)]
+        await self.measure("addadmin", lambda target: self.command("addadmin", *target), prepare)
+
+    async def bench_upgraderoom(self) -> None:
+        # Measured until the background job has invited every member into the replacement room
+        legacy_version = str(int(ROOM_VERSION) - 1)
+        def prepare(_) -> str:
+            return self.server.add_room(ADMIN, room_version=legacy_version, name="Legacy", members=self.members, admins=[BOT])
+        async def run(room_id: str) -> None:
+            stats = self.plugin.operation_stats.get("reinvite_members")
+            done = stats.runs if stats else 0
+            await self.command("upgraderoom", room_id)
+            while (stats := self.plugin.operation_stats.get("reinvite_members")) is None or stats.runs == done:
+                await asyncio.sleep(0.001)
+        await self.measure("upgraderoom", run, prepare)
+
+    async def bench_forgetroom(self) -> None:
+        await self.measure("forgetroom", lambda room_id: self.command("forgetroom", room_id), lambda _: self.server.add_room(BOT))
+
+    async def bench_log_event(self) -> None:
+        # One run queues LOG_EVENTS_PER_RUN entries and flushes them to the logging channel
+        async def run(_):
+            for i in range(LOG_EVENTS_PER_RUN):
+                await self.plugin.log_event(EVENT_TYPE_ROOM_CHANGE, f"Benchmark log entry {i}")
+            await self.plugin.flush_log()
+        await self.measure("log_event", run)
+
+    async def bench_janitor(self) -> None:
+        # Without a sync stream every run has to look up the member count and the latest event of every owned room
+        async def run(_):
+            self.plugin.member_counts.clear()
+            self.plugin.invited_counts.clear()
+            self.plugin.last_activity.clear()
+            await self.plugin.clean_rooms()
+        await self.measure("janitor", run)
+
+    async def run(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            await self.setup(tmp)
+            try:
+                for scenario in self.args.scenarios:
+                    await getattr(self, f"bench_{scenario}")()
+            finally:
+                await self.teardown()
+
+    def report(self) -> None:
+        args = self.args
+        print(f"rooms={args.rooms} members={args.members} latency={args.latency * 1000:g}ms jitter={args.jitter * 1000:g}ms "
+              f"max_parallel={args.max_parallel} repeat={args.repeat}")
+        print(f"{'scenario':<15}{'runs':>6}{'p50 ms':>11}{'p95 ms':>11}{'max ms':>11}{'requests/run':>15}{'KiB/run':>11}")
+        for name, r in self.results.items():
+            print(f"{name:<15}{r['runs']:>6}{r['p50_ms']:>11.1f}{r['p95_ms']:>11.1f}{r['max_ms']:>11.1f}{r['requests_per_run']:>15.1f}{r['kib_per_run']:>11.1f}")
+        print("\nhomeserver requests by endpoint (including setup):")
+        for route, count in self.server.request_counts.most_common():
+            print(f"  {count:>8}  {route}")
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, round(p / 100 * (len(sorted_values) - 1)))]
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=200, help="number of joined rooms, half of them owned by the bot")
+    parser.add_argument("--members", type=int, default=20, help="members per room")
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random latency added or subtracted per request in seconds")
+    parser.add_argument("--repeat", type=int, default=10, help="runs per scenario")
+    parser.add_argument("--max-parallel", type=int, default=10, help="max_parallel_requests config option")
+    parser.add_argument("--log-batch-size", type=int, default=20, help="logging_batch_size config option")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--json", metavar="PATH", help="also write the results to a JSON file")
+    return parser.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    bench = Bench(args)
+    asyncio.run(bench.run())
+    bench.report()
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"parameters": vars(args), "results": bench.results, "requests": dict(bench.server.request_counts)}, file, indent=2)
+
+if __name__ == "__main__":
+    main()
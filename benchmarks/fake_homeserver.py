@@ -0,0 +1,239 @@
+"""An in-process stand-in for the parts of the Matrix client-server API used by the Room Manager.
+
+The fake homeserver keeps all rooms in memory and serves them over a local aiohttp web server,
+so the plugin talks to it through its regular Matrix client without any changes.
+Every request can be delayed by a configurable latency to simulate a remote homeserver.
+"""
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+from aiohttp import web
+
+class Room:
+    def __init__(self, room_id: str) -> None:
+        self.room_id = room_id
+        self.state: dict[tuple[str, str], dict] = {}
+
+    def set_state(self, event_type: str, state_key: str, sender: str, content: dict) -> dict:
+        event = {
+            "type": event_type,
+            "state_key": state_key,
+            "sender": sender,
+            "content": content,
+            "room_id": self.room_id,
+            "event_id": f"$state{next(FakeHomeserver.event_ids)}",
+            "origin_server_ts": int(time.time() * 1000)
+        }
+        self.state[(event_type, state_key)] = event
+        return event
+
+    def membership(self, user_id: str) -> str | None:
+        event = self.state.get(("m.room.member", user_id))
+        return event["content"]["membership"] if event else None
+
+    def members(self, membership: str | None = None) -> list[dict]:
+        return [e for (t, _), e in self.state.items() if t == "m.room.member" and (membership is None or e["content"]["membership"] == membership)]
+
+class FakeHomeserver:
+    """Serves the rooms of a single bot user. Use add_room to populate it before starting the plugin."""
+    event_ids = itertools.count()
+
+    def __init__(self, bot_mxid: str, latency: float = 0.0, jitter: float = 0.0) -> None:
+        self.bot_mxid = bot_mxid
+        self.server_name = bot_mxid.split(":", 1)[1]
+        self.latency = latency
+        self.jitter = jitter
+        self.rooms: dict[str, Room] = {}
+        self.aliases: dict[str, str] = {}
+        self.request_counts: Counter[str] = Counter()
+        self.room_ids = itertools.count()
+        self.runner: web.AppRunner | None = None
+        self.url = ""
+
+    def add_room(self, creator: str, room_version: str = "12", room_type: str | None = None, name: str | None = None,
+                 members: list[str] = (), admins: list[str] = (), join_rule: str = "invite", predecessor: str | None = None) -> str:
+        room = Room(f"!room{next(self.room_ids)}:{self.server_name}")
+        self.rooms[room.room_id] = room
+        create_content = {"room_version": room_version}
+        if room_type:
+            create_content["type"] = room_type
+        if predecessor:
+            create_content["predecessor"] = {"room_id": predecessor}
+        room.set_state("m.room.create", "", creator, create_content)
+        for user_id in dict.fromkeys([creator, self.bot_mxid, *members]):
+            room.set_state("m.room.member", user_id, user_id, {"membership": "join"})
+        room.set_state("m.room.power_levels", "", creator, {"users": {creator: 100, **{a: 100 for a in admins}}})
+        room.set_state("m.room.join_rules", "", creator, {"join_rule": join_rule})
+        if name:
+            room.set_state("m.room.name", "", creator, {"name": name})
+        return room.room_id
+
+    async def start(self) -> None:
+        app = web.Application(middlewares=[self.simulate_latency])
+        prefix = "/_matrix/client/v3"
+        app.router.add_get(prefix + "/joined_rooms", self.joined_rooms)
+        app.router.add_post(prefix + "/createRoom", self.create_room)
+        app.router.add_get(prefix + "/directory/room/{alias}", self.resolve_alias)
+        app.router.add_get(prefix + "/rooms/{room_id}/state", self.get_state)
+        app.router.add_get(prefix + "/rooms/{room_id}/state/{event_type}", self.get_state_event)
+        app.router.add_get(prefix + "/rooms/{room_id}/state/{event_type}/{state_key:.*}", self.get_state_event)
+        app.router.add_put(prefix + "/rooms/{room_id}/state/{event_type}", self.put_state_event)
+        app.router.add_put(prefix + "/rooms/{room_id}/state/{event_type}/{state_key:.*}", self.put_state_event)
+        app.router.add_get(prefix + "/rooms/{room_id}/members", self.get_members)
+        app.router.add_get(prefix + "/rooms/{room_id}/joined_members", self.get_joined_members)
+        app.router.add_get(prefix + "/rooms/{room_id}/messages", self.get_messages)
+        app.router.add_get("/_matrix/client/v1/rooms/{room_id}/hierarchy", self.get_hierarchy)
+        app.router.add_put(prefix + "/rooms/{room_id}/send/{event_type}/{txn_id}", self.send_event)
+        app.router.add_post(prefix + "/rooms/{room_id}/invite", self.invite)
+        app.router.add_post(prefix + "/rooms/{room_id}/upgrade", self.upgrade)
+        app.router.add_post(prefix + "/rooms/{room_id}/leave", self.leave)
+        app.router.add_post(prefix + "/rooms/{room_id}/forget", self.forget)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    @web.middleware
+    async def simulate_latency(self, request: web.Request, handler) -> web.StreamResponse:
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.request_counts[f"{request.method} {route.removeprefix('/_matrix/client/v3')}"] += 1
+        if self.latency > 0 or self.jitter > 0:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        return await handler(request)
+
+    def error(self, status: int, errcode: str, message: str) -> web.Response:
+        return web.json_response({"errcode": errcode, "error": message}, status=status)
+
+    def joined_room(self, request: web.Request) -> Room | web.Response:
+        room = self.rooms.get(request.match_info["room_id"])
+        if room is None or room.membership(self.bot_mxid) != "join":
+            return self.error(403, "M_FORBIDDEN", "You are not joined to this room.")
+        return room
+
+    async def joined_rooms(self, request: web.Request) -> web.Response:
+        return web.json_response({"joined_rooms": [r.room_id for r in self.rooms.values() if r.membership(self.bot_mxid) == "join"]})
+
+    async def create_room(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        creation_content = body.get("creation_content") or {}
+        room_id = self.add_room(
+            self.bot_mxid,
+            room_version=body.get("room_version", "12"),
+            room_type=creation_content.get("type"),
+            name=body.get("name")
+        )
+        room = self.rooms[room_id]
+        if body.get("power_level_content_override"):
+            room.set_state("m.room.power_levels", "", self.bot_mxid, body["power_level_content_override"])
+        for state in body.get("initial_state", []):
+            room.set_state(state["type"], state.get("state_key", ""), self.bot_mxid, state["content"])
+        for user_id in body.get("invite", []):
+            room.set_state("m.room.member", user_id, self.bot_mxid, {"membership": "invite"})
+        if body.get("room_alias_name"):
+            alias = f"#{body['room_alias_name']}:{self.server_name}"
+            self.aliases[alias] = room_id
+            room.set_state("m.room.canonical_alias", "", self.bot_mxid, {"alias": alias})
+        return web.json_response({"room_id": room_id})
+
+    async def resolve_alias(self, request: web.Request) -> web.Response:
+        room_id = self.aliases.get(request.match_info["alias"])
+        if room_id is None:
+            return self.error(404, "M_NOT_FOUND", "Room alias not found.")
+        return web.json_response({"room_id": room_id, "servers": [self.server_name]})
+
+    async def get_state(self, request: web.Request) -> web.Response:
+        room = self.joined_room(request)
+        if isinstance(room, web.Response):
+            return room
+        return web.json_response(list(room.state.values()))
+
+    async def get_state_event(self, request: web.Request) -> web.Response:
+        room = self.joined_room(request)
+        if isinstance(room, web.Response):
+            return room
+        event = room.state.get((request.match_info["event_type"], request.match_info.get("state_key", "")))
+        if event is None:
+            return self.error(404, "M_NOT_FOUND", "Event not found.")
+        return web.json_response(event if request.query.get("format") == "event" else event["content"])
+
+    async def put_state_event(self, request: web.Request) -> web.Response:
+        room = self.joined_room(request)
+        if isinstance(room, web.Response):
+            return room
+        event = room.set_state(request.match_info["event_type"], request.match_info.get("state_key", ""), self.bot_mxid, await request.json())
+        return web.json_response({"event_id": event["event_id"]})
+
+    async def get_members(self, request: web.Request) -> web.Response:
+        room = self.joined_room(request)
+        if isinstance(room, web.Response):
+            return room
+        return web.json_response({"chunk": room.members(request.query.get("membership"))})
+
+    async def get_joined_members(self, request: web.Request) -> web.Response:
+        room = self.joined_room(request)
+        if isinstance(room, web.Response):
+            return room
+        return web.json_response({"joined": {e["state_key"]: {"display_name": None, "avatar_url": None} for e in room.members("join")}})
+
+    async def get_messages(self, request: web.Request) -> web.Response:
+        # Only backwards pagination from the end is supported, the timeline consists of the state events
+        room = self.joined_room(request)
+        if isinstance(room, web.Response):
+            return room
+        limit = int(request.query.get("limit", 10))
+        events = sorted(room.state.values(), key=lambda e: e["origin_server_ts"], reverse=True)[:limit]
+        return web.json_response({"chunk": events, "start": "end", "end": "start"})
+
+    async def get_hierarchy(self, request: web.Request) -> web.Response:
+        # Only the space itself is returned, which is enough for max_depth=1 with limit=1
+        room = self.joined_room(request)
+        if isinstance(room, web.Response):
+            return room
+        create_content = room.state[("m.room.create", "")]["content"]
+        children_state = [{k: e[k] for k in ["type", "state_key", "sender", "content", "origin_server_ts"]} for (t, _), e in room.state.items() if t == "m.space.child"]
+        return web.json_response({"rooms": [{"room_id": room.room_id, "room_type": create_content.get("type"), "num_joined_members": len(room.members("join")),
+                                             "world_readable": False, "guest_can_join": False, "children_state": children_state}]})
+
+    async def send_event(self, request: web.Request) -> web.Response:
+        room = self.joined_room(request)
+        if isinstance(room, web.Response):
+            return room
+        await request.read()
+        return web.json_response({"event_id": f"$event{next(self.event_ids)}"})
+
+    async def invite(self, request: web.Request) -> web.Response:
+        room = self.joined_room(request)
+        if isinstance(room, web.Response):
+            return room
+        user_id = (await request.json())["user_id"]
+        if room.membership(user_id) in ["join", "invite"]:
+            return self.error(403, "M_FORBIDDEN", f"{user_id} is already in the room.")
+        room.set_state("m.room.member", user_id, self.bot_mxid, {"membership": "invite"})
+        return web.json_response({})
+
+    async def upgrade(self, request: web.Request) -> web.Response:
+        room = self.joined_room(request)
+        if isinstance(room, web.Response):
+            return room
+        body = await request.json()
+        name_event = room.state.get(("m.room.name", ""))
+        new_room_id = self.add_room(self.bot_mxid, room_version=body["new_version"], name=name_event["content"]["name"] if name_event else None, predecessor=room.room_id)
+        room.set_state("m.room.tombstone", "", self.bot_mxid, {"replacement_room": new_room_id, "body": "This room has been replaced"})
+        return web.json_response({"replacement_room": new_room_id})
+
+    async def leave(self, request: web.Request) -> web.Response:
+        room = self.rooms.get(request.match_info["room_id"])
+        if room is not None:
+            room.set_state("m.room.member", self.bot_mxid, self.bot_mxid, {"membership": "leave"})
+        return web.json_response({})
+
+    async def forget(self, request: web.Request) -> web.Response:
+        self.rooms.pop(request.match_info["room_id"], None)
+        return web.json_response({})
@@ -0,0 +1,64 @@
+import html
+import re
+from dataclasses import dataclass
+from enum import Enum
+from urllib.parse import unquote
+from mautrix.types import TextMessageEventContent
+
+class ArgumentType(Enum):
+    USER_ID = "user_id"
+    ROOM_ID = "room_id"
+    ROOM_ALIAS = "room_alias"
+    TEXT = "text"
+
+@dataclass(frozen=True)
+class Argument:
+    """A single command argument. Mentions and matrix.to links are already reduced to the Matrix ID they point to."""
+    type: ArgumentType
+    value: str
+
+    @property
+    def is_room(self) -> bool:
+        return self.type in [ArgumentType.ROOM_ID, ArgumentType.ROOM_ALIAS]
+
+# Mentioning a user can look like this: <a href="https://matrix.to/#/@user:server">@user</a>
+# Only the html variant contains the full Matrix ID, since the plain text variant removes the a tag and only keeps @user
+HTML_TOKEN = re.compile(
+    r"""<a\s[^>]*?href=(['"])(?P<link>[^'"]*)\1[^>]*>.*?</a>"""  # links, their text is not an argument
+    r"|<[^>]*>"                                                     # other tags like <br/> only separate arguments
+    r"|(?P<word>[^\s<]+)",
+    re.IGNORECASE | re.DOTALL
+)
+PLAIN_TOKEN = re.compile(r"\S+")
+# Links to rooms may contain an event ID and via servers after the room ID or alias
+MATRIX_TO_LINK = re.compile(r"https?://matrix\.to/#/(?P<target>[^/?]+)\S*", re.IGNORECASE)
+USER_ID = re.compile(r"@[^\s:]+:\S+")
+# Room IDs of room version 12 and newer have no server name
+ROOM_ID = re.compile(r"![^\s:]+(?::\S+)?")
+ROOM_ALIAS = re.compile(r"#[^\s:]+:\S+")
+
+def parse_argument(value: str) -> Argument:
+    match = MATRIX_TO_LINK.fullmatch(value)
+    if match:
+        value = unquote(match.group("target"))
+    for argument_type, pattern in [(ArgumentType.USER_ID, USER_ID), (ArgumentType.ROOM_ID, ROOM_ID), (ArgumentType.ROOM_ALIAS, ROOM_ALIAS)]:
+        if pattern.fullmatch(value):
+            return Argument(argument_type, value)
+    return Argument(ArgumentType.TEXT, value)
+
+def tokenize(content: TextMessageEventContent) -> list[Argument]:
+    """Splits a message into typed arguments in a single pass, the command itself is the first argument.
+    The formatted body is preferred, since only its mentions contain the full Matrix ID.
+    """
+    if not content.formatted_body:
+        return [parse_argument(m.group()) for m in PLAIN_TOKEN.finditer(content.body)]
+    arguments = []
+    for match in HTML_TOKEN.finditer(content.formatted_body):
+        value = match.group("link") or match.group("word")
+        if value:
+            arguments.append(parse_argument(html.unescape(value)))
+    return arguments
+
+def parse_command_args(content: TextMessageEventContent) -> list[Argument]:
+    """Returns the arguments of a command without the command itself."""
+    return tokenize(content)[1:]
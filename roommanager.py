@@ -1,14 +1,39 @@
 import re
-from typing import Type
+import json
+import time
+import asyncio
+import functools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Type, TypeVar, Callable, Awaitable, Iterable, Hashable, Generic, Iterator
+from aiohttp.web import Request, Response
 from maubot import Plugin, MessageEvent
-from maubot.handlers import command
-from mautrix.api import Method, Path
+from maubot.handlers import command, event, web
+from mautrix.api import Method, Path, HTTPAPI
+from mautrix.client import InternalEventType
+from mautrix.errors import MatrixRequestError, MNotFound
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
-from mautrix.types import RoomDirectoryVisibility, Membership, EventType, TextMessageEventContent, PowerLevelStateEventContent, RoomType, RoomID, MessageType
+from mautrix.util.async_db import UpgradeTable, Connection
+from commandargs import ArgumentType, parse_command_args
+from mautrix.types import PaginationDirection, RoomDirectoryVisibility, Membership, EventType, TextMessageEventContent, PowerLevelStateEventContent, RoomType, RoomID, RoomAlias, UserID, MessageType, StateEvent, JoinRule, JoinRulesStateEventContent
 
 ROOM_VERSION = "12"
 EVENT_TYPE_ROOM_CHANGE = "ROOM_CHANGE"
 EVENT_TYPE_PERMISSION_CHANGE = "PERMISSION_CHANGE"
+RATE_LIMIT_RETRIES = 5
+RATE_LIMIT_BACKOFF = 1.0
+UPGRADE_INVITE_BATCH_SIZE = 100
+HTML_TAG = re.compile(r"<.*?>")
+ROOM_TEMPLATE_OPTIONS = ["type", "power_levels", "encryption", "join_rule", "initial_state", "children"]
+ROOM_TEMPLATE_JOIN_RULES = ["public", "invite", "knock", "restricted"]
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Cached in place of state events that do not exist in a room
+STATE_NOT_FOUND = object()
 
 DEFAULT_POWER_LEVELS = {
     "users_default": 0,
@@ -39,12 +64,238 @@ DEFAULT_POWER_LEVELS = {
     "historical": 100
 }
 
+upgrade_table = UpgradeTable()
+
+@upgrade_table.register(description="Registry of managed rooms")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE managed_room (
+            room_id         TEXT PRIMARY KEY,
+            room_version    TEXT NOT NULL,
+            room_type       TEXT,
+            visibility      TEXT,
+            creator         TEXT,
+            admins          TEXT NOT NULL,
+            predecessor     TEXT,
+            name            TEXT,
+            canonical_alias TEXT
+        )"""
+    )
+
+@dataclass
+class OwnedRoom:
+    """A room created by this Room Manager instance, as stored in the managed room registry.
+    The creator is the user who requested the room, since the room creator in Matrix terms is always the bot itself.
+    """
+    room_id: RoomID
+    room_version: str
+    room_type: RoomType | None = None
+    visibility: str | None = None
+    creator: UserID | None = None
+    admins: list[UserID] = field(default_factory=list)
+    predecessor: RoomID | None = None
+    name: str | None = None
+    canonical_alias: RoomAlias | None = None
+
+    @property
+    def display_name(self) -> str:
+        if self.name:
+            return self.name
+        elif self.canonical_alias:
+            return self.canonical_alias
+        else:
+            return "Unnamed Room"
+
+@dataclass(frozen=True)
+class RoomTemplate:
+    """A validated room template from the config with the parts of the creation payload that are the same for every room.
+    Templates are shared by all rooms created from them, so neither the template nor its payload may be modified.
+    """
+    name: str
+    room_type: RoomType | None
+    power_levels: dict
+    initial_state: tuple[dict, ...]
+    join_rule: str | None
+    # Pairs of child room name and child room template, only used for spaces
+    children: tuple[tuple[str, str], ...]
+
+def merge_power_levels(base: dict, override: dict) -> dict:
+    """Returns a deep merge of both power level dicts without modifying either of them."""
+    merged = dict(base)
+    for key, value in override.items():
+        merged[key] = merge_power_levels(base[key], value) if isinstance(value, dict) and isinstance(base.get(key), dict) else value
+    return merged
+
+def parse_room_templates(config: dict) -> dict[str, RoomTemplate]:
+    """Validates the room_templates config option and precomputes the creation payload of every template.
+    Raises a ValueError that names the invalid template and option.
+    """
+    # Copying through JSON detaches the templates from the config and rejects values that cannot be sent to the homeserver
+    templates = json.loads(json.dumps(config or {}))
+    parsed = {}
+    for name, options in templates.items():
+        if not isinstance(options, dict):
+            raise ValueError(f"Room template {name} must be a mapping.")
+        unknown_options = [o for o in options if o not in ROOM_TEMPLATE_OPTIONS]
+        if len(unknown_options) > 0:
+            raise ValueError(f"Room template {name} has unknown options: {', '.join(unknown_options)}.")
+        room_type = options.get("type", "room")
+        if room_type not in ["room", "space"]:
+            raise ValueError(f"The type of room template {name} must be room or space.")
+        power_levels = options.get("power_levels") or {}
+        if not isinstance(power_levels, dict) or not all(
+            isinstance(v, int) or (isinstance(v, dict) and all(isinstance(level, int) for level in v.values())) for v in power_levels.values()
+        ):
+            raise ValueError(f"The power_levels of room template {name} must map to power levels or to mappings of power levels.")
+        encryption = options.get("encryption", True)
+        if not isinstance(encryption, bool):
+            raise ValueError(f"The encryption option of room template {name} must be true or false.")
+        join_rule = options.get("join_rule")
+        if join_rule is not None and join_rule not in ROOM_TEMPLATE_JOIN_RULES:
+            raise ValueError(f"The join_rule of room template {name} must be one of {', '.join(ROOM_TEMPLATE_JOIN_RULES)}.")
+        initial_state = options.get("initial_state") or []
+        if not isinstance(initial_state, list) or not all(
+            isinstance(e, dict) and isinstance(e.get("type"), str) and isinstance(e.get("state_key", ""), str) and isinstance(e.get("content"), dict) for e in initial_state
+        ):
+            raise ValueError(f"Every initial_state entry of room template {name} needs a type, a content mapping and optionally a state_key.")
+        children = options.get("children") or []
+        if not isinstance(children, list) or not all(isinstance(c, dict) and isinstance(c.get("name"), str) and c["name"].strip() for c in children):
+            raise ValueError(f"Every child of room template {name} needs a name.")
+        if room_type != "space" and len(children) > 0:
+            raise ValueError(f"Room template {name} is not a space template and cannot have children.")
+        if encryption:
+            initial_state.insert(0, {"type": "m.room.encryption", "content": {"algorithm": "m.megolm.v1.aes-sha2"}})
+        parsed[name] = RoomTemplate(
+            name=name,
+            room_type=RoomType.SPACE if room_type == "space" else None,
+            power_levels=merge_power_levels(json.loads(json.dumps(DEFAULT_POWER_LEVELS)), power_levels),
+            initial_state=tuple({"type": e["type"], "state_key": e.get("state_key", ""), "content": e["content"]} for e in initial_state),
+            join_rule=join_rule,
+            children=tuple((c["name"].strip(), c.get("template", "room")) for c in children)
+        )
+    for template_name, room_type in [("room", None), ("space", RoomType.SPACE)]:
+        if template_name not in parsed or parsed[template_name].room_type != room_type:
+            raise ValueError(f"The room template {template_name} is required and must have the type {template_name}.")
+    for template in parsed.values():
+        for child_name, child_template in template.children:
+            if child_template not in parsed or parsed[child_template].room_type is not None:
+                raise ValueError(f"The child {child_name} of room template {template.name} must use an existing room template, not {child_template}.")
+    return parsed
+
+@dataclass
+class OperationStats:
+    """Latency and homeserver usage of a command or background operation, summed up over all runs."""
+    runs: int = 0
+    errors: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+    requests: int = 0
+    rate_limited: int = 0
+    bytes_received: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+def instrumented(func: Callable[..., Awaitable[R]]) -> Callable[..., Awaitable[R]]:
+    """Records the wall time and homeserver usage of every call of a RoomManager method under the method name."""
+    @functools.wraps(func)
+    async def wrapper(self: "RoomManager", *args, **kwargs) -> R:
+        with self.measure(func.__name__):
+            return await func(self, *args, **kwargs)
+    return wrapper
+
+def install_request_hook(api: HTTPAPI) -> tuple[ContextVar[OperationStats | None], ContextVar[asyncio.Semaphore | None]]:
+    """Wraps the request method of the Matrix API object to count requests, rate limits and received bytes and to limit parallel requests.
+    Requests are counted for the statistics in the first returned context variable, which the operations of all plugin instances set while they run.
+    If the second context variable holds a semaphore, every request waits for it, so it limits the requests in flight instead of the calls that send them.
+    The API object is shared with other plugins and outlives plugin reloads, so it is only wrapped once and the wrapper keeps no plugin instance alive.
+    """
+    current_stats = api.__dict__.get("roommanager_request_stats")
+    request_limit = api.__dict__.get("roommanager_request_limit")
+    if current_stats is not None and request_limit is not None:
+        return current_stats, request_limit
+    current_stats = ContextVar("roommanager_request_stats", default=None)
+    request_limit = ContextVar("roommanager_request_limit", default=None)
+    send = api._send
+
+    async def limited_send(*args, **kwargs):
+        semaphore = request_limit.get()
+        if semaphore is None:
+            return await send(*args, **kwargs)
+        async with semaphore:
+            return await send(*args, **kwargs)
+
+    async def request_hook(*args, **kwargs):
+        stats = current_stats.get()
+        if stats is None:
+            return await limited_send(*args, **kwargs)
+        stats.requests += 1
+        try:
+            data, response = await limited_send(*args, **kwargs)
+        except MatrixRequestError as e:
+            if e.http_status == 429:
+                stats.rate_limited += 1
+            raise
+        # Chunked responses have no content length, so the bytes read from the response body are counted instead
+        stats.bytes_received += response.content.total_bytes
+        return data, response
+
+    api._send = request_hook
+    api.roommanager_request_stats = current_stats
+    api.roommanager_request_limit = request_limit
+    return current_stats, request_limit
+
+class LRUCache(Generic[T]):
+    """A least recently used cache with an optional time to live per entry."""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.entries: OrderedDict[Hashable, tuple[T, float | None]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> T | None:
+        entry = self.entries.get(key)
+        if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, value: T, ttl: float | None) -> None:
+        """Stores a value. A ttl of None keeps the entry until it is evicted or invalidated."""
+        self.entries[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+        self.entries.move_to_end(key)
+        self.evict()
+
+    def pop(self, key: Hashable) -> None:
+        self.entries.pop(key, None)
+
+    def evict(self) -> None:
+        while len(self.entries) > max(0, self.max_size):
+            self.entries.popitem(last=False)
+
 class Config(BaseProxyConfig):
   def do_update(self, helper: ConfigUpdateHelper) -> None:
     helper.copy("administrators")
     helper.copy("silence_success_responses")
     helper.copy("logging_channel")
     helper.copy("logging_events")
+    helper.copy("logging_flush_interval")
+    helper.copy("logging_batch_size")
+    helper.copy("logging_buffer_size")
+    helper.copy("max_parallel_requests")
+    helper.copy("listrooms_page_size")
+    helper.copy("state_cache_size")
+    helper.copy("state_cache_ttl")
+    helper.copy("room_templates")
+    helper.copy("janitor_interval")
+    helper.copy("janitor_max_parallel")
+    helper.copy("janitor_max_age")
+    helper.copy("janitor_action")
+    helper.copy("janitor_dry_run")
+    helper.copy("janitor_batch_size")
 
 class RoomManager(Plugin):
   
@@ -52,103 +303,427 @@ class RoomManager(Plugin):
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
 
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
+
     async def start(self) -> None:
         self.config.load_and_update()
+        self.room_templates = parse_room_templates(self.config["room_templates"])
+        self.owned_rooms: dict[RoomID, OwnedRoom] = {}
+        self.registry_lock = asyncio.Lock()
+        # Keys are (room_id, event_type, state_key), the joined member list of a room is stored with the state key None
+        self.state_cache: LRUCache[StateEvent | list[UserID] | object] = LRUCache(self.config["state_cache_size"])
+        self.alias_cache: LRUCache[RoomID] = LRUCache(self.config["state_cache_size"])
+        self.room_index_task = self.sched.run_later(0, self.load_room_index())
+        # Joined member counts per room, taken from the sync room summaries or /joined_members
+        self.member_counts: dict[RoomID, int] = {}
+        # Invited member counts per room, taken from the sync room summaries or /members
+        self.invited_counts: dict[RoomID, int] = {}
+        # Timestamps of the latest event per room in milliseconds, taken from the sync timeline or /messages
+        self.last_activity: dict[RoomID, int] = {}
+        self.log_buffer: deque[str] = deque()
+        self.log_dropped = 0
+        self.log_dropped_total = 0
+        self.log_flush_requested = asyncio.Event()
+        self.log_flush_lock = asyncio.Lock()
+        self.sched.run_later(0, self.run_log_writer())
+        self.sched.run_later(0, self.run_janitor())
+        self.operation_stats: dict[str, OperationStats] = {}
+        self.current_stats, self.request_limit = install_request_hook(self.client.api)
+
+    async def stop(self) -> None:
+        # Deliver what is left in the log buffer, but do not retry for long while shutting down
+        try:
+            await self.flush_log(retry=False)
+        except Exception:
+            self.log.warning(f"Could not deliver {len(self.log_buffer)} buffered log entries on shutdown")
+
+    @contextmanager
+    def measure(self, name: str) -> Iterator[OperationStats]:
+        """Attributes the wall time and all homeserver requests of the enclosed code to the named operation."""
+        stats = self.operation_stats.setdefault(name, OperationStats())
+        token = self.current_stats.set(stats)
+        start = time.monotonic()
+        try:
+            yield stats
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            stats.runs += 1
+            stats.total_seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+            self.current_stats.reset(token)
+
+    def record_cache_access(self, hit: bool) -> None:
+        stats = self.current_stats.get()
+        if stats is not None:
+            if hit:
+                stats.cache_hits += 1
+            else:
+                stats.cache_misses += 1
+
+    def on_external_config_update(self) -> None:
+        super().on_external_config_update()
+        for cache in [self.state_cache, self.alias_cache]:
+            cache.max_size = self.config["state_cache_size"]
+            cache.evict()
+        try:
+            self.room_templates = parse_room_templates(self.config["room_templates"])
+        except ValueError as e:
+            self.log.error(f"Keeping the previous room templates, since the new ones are invalid: {e}")
+
+    @instrumented
+    async def load_room_index(self) -> None:
+        """Loads the managed room registry from the database into memory.
+        Afterwards the index and the registry are kept up to date by the sync event handlers below.
+        """
+        for row in await self.database.fetch("SELECT * FROM managed_room"):
+            self.owned_rooms.setdefault(row["room_id"], OwnedRoom(
+                room_id=row["room_id"],
+                room_version=row["room_version"],
+                room_type=RoomType.deserialize(row["room_type"]) if row["room_type"] else None,
+                visibility=row["visibility"],
+                creator=row["creator"],
+                admins=json.loads(row["admins"]),
+                predecessor=row["predecessor"],
+                name=row["name"],
+                canonical_alias=row["canonical_alias"]
+            ))
+        self.log.debug(f"Room index loaded with {len(self.owned_rooms)} owned rooms")
+
+    async def save_owned_room(self, room: OwnedRoom) -> None:
+        """Writes the current state of an index entry to the managed room registry."""
+        # The lock keeps the writes in the order of the changes, so an older state never overwrites a newer one
+        async with self.registry_lock:
+            await self.database.execute(
+                """INSERT INTO managed_room (room_id, room_version, room_type, visibility, creator, admins, predecessor, name, canonical_alias)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                ON CONFLICT (room_id) DO UPDATE SET room_version=excluded.room_version, room_type=excluded.room_type,
+                    visibility=excluded.visibility, creator=excluded.creator, admins=excluded.admins, predecessor=excluded.predecessor,
+                    name=excluded.name, canonical_alias=excluded.canonical_alias""",
+                room.room_id, room.room_version, room.room_type.serialize() if room.room_type else None, room.visibility, room.creator,
+                json.dumps(room.admins), room.predecessor, room.name, room.canonical_alias
+            )
+
+    async def forget_owned_room(self, room_id: RoomID) -> None:
+        """Removes a room from the index and the managed room registry."""
+        if self.owned_rooms.pop(room_id, None) is not None:
+            async with self.registry_lock:
+                await self.database.execute("DELETE FROM managed_room WHERE room_id=$1", room_id)
+
+    async def update_owned_room(self, room_id: RoomID, **changes) -> None:
+        """Applies the changes to the index entry of the room and saves it, if the room is owned by this instance."""
+        room = self.owned_rooms.get(room_id)
+        if room is not None:
+            for key, value in changes.items():
+                setattr(room, key, value)
+            await self.save_owned_room(room)
+
+    async def load_owned_room(self, room_id: RoomID) -> OwnedRoom | None:
+        """Builds an index entry for the room from its current state, or returns None if the room is not owned by this instance."""
+        create_event = await self.get_room_state_event(room_id, EventType.ROOM_CREATE)
+        if create_event is None or create_event.sender != self.client.mxid:
+            return None
+        name_event, alias_event, tombstone_event, join_rules_event, power_levels_event = await self.get_room_state_events(
+            room_id, EventType.ROOM_NAME, EventType.ROOM_CANONICAL_ALIAS, EventType.ROOM_TOMBSTONE, EventType.ROOM_JOIN_RULES, EventType.ROOM_POWER_LEVELS
+        )
+        if tombstone_event is not None:
+            return None
+        return OwnedRoom(
+            room_id=room_id,
+            room_version=create_event.content.room_version,
+            room_type=create_event.content.type,
+            visibility=self.get_visibility(join_rules_event.content) if join_rules_event else None,
+            admins=self.get_admins(power_levels_event.content) if power_levels_event else [],
+            predecessor=create_event.content.predecessor.room_id if create_event.content.predecessor else None,
+            name=name_event.content.name if name_event else None,
+            canonical_alias=alias_event.content.canonical_alias if alias_event else None
+        )
+
+    def get_visibility(self, join_rules: JoinRulesStateEventContent) -> str:
+        return "public" if join_rules.join_rule == JoinRule.PUBLIC else "private"
+
+    def get_admins(self, power_levels: PowerLevelStateEventContent) -> list[UserID]:
+        return [u for u, level in power_levels.users.items() if level >= 100 and u != self.client.mxid]
+
+    @command.new(help="Scan all joined rooms and add the rooms owned by this instance to the room registry (only for instance admins).")
+    @instrumented
+    async def backfillrooms(self, evt: MessageEvent) -> None:
+        if not evt.sender in self.config["administrators"]:
+            await evt.reply("Only instance administrators can use this command. You can manage instance administrators via the maubot Web UI.", allow_html=True)
+            return
+        await self.room_index_task
+        joined_rooms = [r for r in await self.client.get_joined_rooms() if r not in self.owned_rooms]
+        await evt.reply(f"Scanning {len(joined_rooms)} rooms that are not yet registered.", allow_html=True)
+        # The scan can take a while, so the rooms found are reported chunk by chunk
+        chunk_size = self.config["listrooms_page_size"]
+        added_count = 0
+        for start in range(0, len(joined_rooms), chunk_size):
+            chunk = joined_rooms[start:start + chunk_size]
+            added_rooms = [r for r in await self.gather_limited(self.load_owned_room, chunk) if isinstance(r, OwnedRoom)]
+            # Sync may have indexed a room during the scan, its index entry is newer than the loaded state
+            added_rooms = [self.owned_rooms.setdefault(room.room_id, room) for room in added_rooms]
+            for room in added_rooms:
+                await self.save_owned_room(room)
+            added_count += len(added_rooms)
+            if len(added_rooms) > 0:
+                await evt.reply(f"Added {len(added_rooms)} rooms to the registry ({start + len(chunk)} of {len(joined_rooms)} scanned):<br>" + "<br>".join(self.format_owned_room(r) for r in added_rooms), allow_html=True)
+        await evt.reply(f"Scanned {len(joined_rooms)} rooms that were not yet registered and added {added_count} rooms owned by this instance to the registry.", allow_html=True)
+
+    @event.on(EventType.ROOM_CREATE)
+    async def handle_room_create(self, evt: StateEvent) -> None:
+        if evt.sender == self.client.mxid and evt.room_id not in self.owned_rooms:
+            room = OwnedRoom(
+                room_id=evt.room_id,
+                room_version=evt.content.room_version,
+                room_type=evt.content.type,
+                predecessor=evt.content.predecessor.room_id if evt.content.predecessor else None
+            )
+            self.owned_rooms[evt.room_id] = room
+            await self.save_owned_room(room)
+
+    @event.on(EventType.ROOM_NAME)
+    async def handle_room_name(self, evt: StateEvent) -> None:
+        await self.update_owned_room(evt.room_id, name=evt.content.name)
+
+    @event.on(EventType.ROOM_CANONICAL_ALIAS)
+    async def handle_room_canonical_alias(self, evt: StateEvent) -> None:
+        # The homeserver only accepts aliases that point to the room, so they can be cached without resolving them
+        for alias in [evt.content.canonical_alias, *(evt.content.alt_aliases or [])]:
+            if alias:
+                self.alias_cache.put(alias, evt.room_id, self.config["state_cache_ttl"])
+        await self.update_owned_room(evt.room_id, canonical_alias=evt.content.canonical_alias)
+
+    @event.on(EventType.ROOM_JOIN_RULES)
+    async def handle_room_join_rules(self, evt: StateEvent) -> None:
+        await self.update_owned_room(evt.room_id, visibility=self.get_visibility(evt.content))
+
+    @event.on(EventType.ROOM_POWER_LEVELS)
+    async def handle_room_power_levels(self, evt: StateEvent) -> None:
+        await self.update_owned_room(evt.room_id, admins=self.get_admins(evt.content))
+
+    @event.on(EventType.ROOM_TOMBSTONE)
+    async def handle_room_tombstone(self, evt: StateEvent) -> None:
+        # Upgraded rooms are superseded by their replacement room, which gets indexed through its own create event
+        await self.forget_owned_room(evt.room_id)
+
+    @event.on(EventType.ROOM_MEMBER)
+    async def handle_room_member(self, evt: StateEvent) -> None:
+        if evt.state_key == self.client.mxid and evt.content.membership in [Membership.LEAVE, Membership.BAN]:
+            await self.forget_owned_room(evt.room_id)
+
+    @event.on(EventType.ALL)
+    async def handle_state_change(self, evt: StateEvent) -> None:
+        if getattr(evt, "state_key", None) is None:
+            return
+        self.state_cache.pop((evt.room_id, evt.type, evt.state_key))
+        if evt.type == EventType.ROOM_MEMBER:
+            self.state_cache.pop((evt.room_id, EventType.ROOM_MEMBER, None))
+
+    @event.on(InternalEventType.SYNC_SUCCESSFUL)
+    async def handle_sync_summaries(self, sync: dict) -> None:
+        rooms = sync["data"].get("rooms", {})
+        for room_id, room_data in rooms.get("join", {}).items():
+            timeline_events = room_data.get("timeline", {}).get("events", [])
+            if len(timeline_events) > 0 and "origin_server_ts" in timeline_events[-1]:
+                self.last_activity[room_id] = timeline_events[-1]["origin_server_ts"]
+            summary = room_data.get("summary", {})
+            membership_changed = any(e.get("type") == EventType.ROOM_MEMBER.t for section in ["state", "timeline"] for e in room_data.get(section, {}).get("events", []))
+            for key, counts in [("m.joined_member_count", self.member_counts), ("m.invited_member_count", self.invited_counts)]:
+                if summary.get(key) is not None:
+                    counts[room_id] = summary[key]
+                elif membership_changed:
+                    # The membership changed without a new count in the summary, so the count has to be fetched again
+                    counts.pop(room_id, None)
+        for room_id in rooms.get("leave", {}):
+            self.member_counts.pop(room_id, None)
+            self.invited_counts.pop(room_id, None)
+            self.last_activity.pop(room_id, None)
 
     @command.new(help="List all rooms owned by this Room Manager instance.")
-    async def listrooms(self, evt: MessageEvent) -> None:
-        rooms = {}
-        for room in await self.client.get_joined_rooms():
-            try:
-                creation_event =[e for e in (await self.client.get_state(room)) if e.type == EventType.ROOM_CREATE][0]
-                if creation_event.sender == self.client.mxid and creation_event.content.room_version == ROOM_VERSION:
-                    rooms[room] = creation_event.content.type
-            except Exception:
-                continue
+    @command.argument("filters", label="[page] [spaces/rooms] [public/private] [mine] [sort:name/id] [name]", pass_raw=True, required=False)
+    @instrumented
+    async def listrooms(self, evt: MessageEvent, filters: str) -> None:
+        # The index is loaded in the background on startup, the first listing may have to wait for it
+        await self.room_index_task
+        page = 1
+        room_type = visibility = None
+        only_mine = False
+        sort = "name"
+        name_parts = []
+        args = filters.split()
+        # Only the first argument is a page number, so room names may contain numbers
+        if len(args) > 0 and args[0].isdigit():
+            page = max(1, int(args.pop(0)))
+        for arg in args:
+            if arg in ["spaces", "rooms"]:
+                room_type = arg
+            elif arg in ["public", "private"]:
+                visibility = arg
+            elif arg == "mine":
+                only_mine = True
+            elif arg in ["sort:name", "sort:id"]:
+                sort = arg[5:]
+            else:
+                name_parts.append(arg.lower())
+        name = " ".join(name_parts)
+
+        rooms = [
+            r for r in self.owned_rooms.values()
+            if r.room_version == ROOM_VERSION
+            and (room_type is None or (r.room_type == RoomType.SPACE) == (room_type == "spaces"))
+            and (visibility is None or r.visibility == visibility)
+            and (not only_mine or evt.sender in r.admins)
+            and name in r.display_name.lower()
+        ]
         if len(rooms) == 0:
             await evt.reply("No rooms created by this Room Manager instance were found.", allow_html=True)
-        else:
-            room_mentions = [f"{self.mention_mxid(r)} / {await self.get_room_name(r)} ({'Space' if rooms[r] == RoomType.SPACE else 'Room'})" for r in rooms.keys()]
-            await evt.reply(f"Rooms created by this Room Manager instance:<br>" + "<br>".join(room_mentions), allow_html=True)
+            return
+        rooms.sort(key=lambda r: r.display_name.lower() if sort == "name" else r.room_id)
+        page_size = self.config["listrooms_page_size"]
+        page_count = (len(rooms) + page_size - 1) // page_size
+        page = min(page, page_count)
+        room_mentions = [self.format_owned_room(r) for r in rooms[(page - 1) * page_size:page * page_size]]
+        message = f"Rooms created by this Room Manager instance (page {page} of {page_count}, {len(rooms)} rooms):<br>" + "<br>".join(room_mentions)
+        if page < page_count:
+            next_page_command = " ".join(["!listrooms", str(page + 1)] + args)
+            message += f"<br>Use <code>{next_page_command}</code> to see the next page."
+        await evt.reply(message, allow_html=True)
+
+    def format_owned_room(self, room: OwnedRoom) -> str:
+        return f"{self.mention_mxid(room.room_id)} / {room.display_name} ({'Space' if room.room_type == RoomType.SPACE else 'Room'})"
 
     @command.new(help="Creates a new room and adds you as an administrator.")
     @command.argument("visibility", label="public/private", matches=r"^(public|private)$", required=True)
-    @command.argument("name", label="Room name", pass_raw=True)
+    @command.argument("name", label="[template:<name>] Room name", pass_raw=True)
+    @instrumented
     async def createroom(self, evt: MessageEvent, visibility: str, name: str) -> None:
-        await self._createroom(evt, visibility, name)
+        await self._createroom(evt, visibility, name, "room")
 
-    @command.new(help="Creates a new space and adds you as an administrator.")
+    @command.new(help="Creates a new space with the child rooms of its template and adds you as an administrator.")
     @command.argument("visibility", label="public/private", matches=r"^(public|private)$", required=True)
-    @command.argument("name", label="Space name", pass_raw=True)
+    @command.argument("name", label="[template:<name>] Space name", pass_raw=True)
+    @instrumented
     async def createspace(self, evt: MessageEvent, visibility: str, name: str) -> None:
-        await self._createroom(evt, visibility, name, creation_content={"type": "m.space"})
+        await self._createroom(evt, visibility, name, "space")
 
-    async def _createroom(self, evt: MessageEvent, visibility: str, name: str, creation_content: dict|None = None) -> str:
-        room_type = "room" if creation_content is None else "space"
+    async def _createroom(self, evt: MessageEvent, visibility: str, name: str, room_type: str) -> None:
         name = name.rstrip("<br/>").strip()
+        template_name = room_type
+        if name.startswith("template:"):
+            template_name, _, name = name[9:].partition(" ")
+            name = name.strip()
         if name == "":
             await evt.reply(f"Please provide a valid {room_type} name.")
             return
+        template = self.room_templates.get(template_name)
+        if template is None or (template.room_type == RoomType.SPACE) != (room_type == "space"):
+            templates = [t.name for t in self.room_templates.values() if (t.room_type == RoomType.SPACE) == (room_type == "space")]
+            await evt.reply(f"There is no {room_type} template called {template_name}. Available templates: {', '.join(templates)}", allow_html=True)
+            return
+        if template.join_rule == "restricted":
+            await evt.reply(f"The template {template_name} is restricted to members of a space and can only be used for the child rooms of a space template.", allow_html=True)
+            return
         is_public = visibility[0].rstrip("<br/>").strip() == "public"
-        initial_state = [
-            {
-                "type": "m.room.encryption",
-                "state_key": "",
-                "content": {"algorithm": "m.megolm.v1.aes-sha2"}
-            },
-            {
-                "type": "m.room.join_rules",
-                "state_key": "",
-                "content": {"join_rule": "public" if is_public else "invite"}
-            }
-        ]
-        power_level_override = DEFAULT_POWER_LEVELS | {"users": {evt.sender: 100}}
-        if room_type == "space":
-            power_level_override["events_default"] = 100
-            power_level_override["events"]["m.reaction"] = 100
-            power_level_override["events"]["m.room.redaction"] = 100
-            power_level_override["events"]["m.space.child"] = 0
-            power_level_override["events"]["org.matrix.msc3401.call.member"] = 50
-            power_level_override["events"]["org.matrix.msc3401.call"] = 50
-        room_id = (await self.client.create_room(
-            alias_localpart=name.replace(" ", "-") if is_public else None, 
-            visibility=RoomDirectoryVisibility.PUBLIC if is_public else RoomDirectoryVisibility.PRIVATE, 
-            name=name, 
-            invitees=[evt.sender],
+        try:
+            room_id = await self.create_owned_room(evt.sender, template, name, is_public)
+        except Exception:
+            await evt.reply(f"Could not create the {room_type} {name}.", allow_html=True)
+            return
+
+        # The child rooms are created concurrently and already point to the space, the space then lists all of them
+        child_names = [child_name for child_name, _ in template.children]
+        results = await self.gather_limited(
+            lambda child: self.create_owned_room(evt.sender, self.room_templates[child[1]], child[0], is_public, space_id=room_id),
+            template.children
+        )
+        child_ids = [r for r in results if not isinstance(r, Exception)]
+        via = [self.client.mxid.split(":", 1)[1]]
+        link_results = await self.gather_limited(
+            lambda child_id: self.retry_rate_limited(self.client.send_state_event, room_id, EventType.SPACE_CHILD, {"via": via}, child_id),
+            child_ids
+        )
+        failed_names = [n for n, r in zip(child_names, results) if isinstance(r, Exception)]
+        failed_names += [self.mention_mxid(c) for c, r in zip(child_ids, link_results) if isinstance(r, Exception)]
+
+        message = f"Created {room_type} {self.mention_mxid(room_id)} with visibility {visibility[0]}"
+        if len(child_ids) > 0:
+            message += f" and the child rooms " + ", ".join(self.mention_mxid(c) for c in child_ids)
+        message += "."
+        if len(failed_names) > 0:
+            message += " The following child rooms could not be created or linked: " + ", ".join(failed_names)
+        if len(failed_names) > 0 or not self.config["silence_success_responses"] or not await self.is_group_chat(evt.room_id):
+            await evt.reply(message, allow_html=True)
+        await self.log_event(EVENT_TYPE_ROOM_CHANGE, f"{self.mention_mxid(evt.sender)} created the {room_type} {self.mention_mxid(room_id)} with visibility {visibility[0]}"
+                             + (f" and {len(child_ids)} child rooms." if len(child_ids) > 0 else "."))
+
+    async def create_owned_room(self, sender: UserID, template: RoomTemplate, name: str, is_public: bool, space_id: RoomID | None = None) -> RoomID:
+        """Creates a room from the template with the sender as administrator and adds it to the registry.
+        Child rooms of a space get an m.space.parent event and restricted child rooms can be joined by all members of the space.
+        """
+        join_rules = {"join_rule": template.join_rule or ("public" if is_public else "invite")}
+        initial_state = list(template.initial_state)
+        alias_name = name
+        if space_id is not None:
+            initial_state.append({"type": "m.space.parent", "state_key": space_id, "content": {"via": [self.client.mxid.split(":", 1)[1]], "canonical": True}})
+            if join_rules["join_rule"] == "restricted":
+                join_rules["allow"] = [{"type": "m.room_membership", "room_id": space_id}]
+            # Child rooms of different spaces often share their names, so their aliases start with the space name
+            space = self.owned_rooms.get(space_id)
+            alias_name = f"{space.display_name if space else space_id} {name}"
+        initial_state.append({"type": "m.room.join_rules", "state_key": "", "content": join_rules})
+        # Only the top level of the template is copied, the nested power levels of the template are sent as they are
+        power_level_override = template.power_levels | {"users": template.power_levels.get("users", {}) | {sender: 100}}
+        room_id = await self.client.create_room(
+            alias_localpart=alias_name.replace(" ", "-") if is_public else None,
+            visibility=RoomDirectoryVisibility.PUBLIC if is_public else RoomDirectoryVisibility.PRIVATE,
+            name=name,
+            invitees=[sender],
             initial_state=initial_state,
-            creation_content=creation_content,
-            room_version=ROOM_VERSION, 
+            creation_content={"type": template.room_type.serialize()} if template.room_type else None,
+            room_version=ROOM_VERSION,
             power_level_override=power_level_override
-        ))
-        if not self.config["silence_success_responses"] or not await self.is_group_chat(evt.room_id):
-            await evt.reply(f"Created {room_type} {self.mention_mxid(room_id)} with visibility {visibility[0]}.", allow_html=True)
-        await self.log_event(EVENT_TYPE_ROOM_CHANGE, f"{self.mention_mxid(evt.sender)} created the {room_type} {self.mention_mxid(room_id)} with visibility {visibility[0]}.")
+        )
+        self.owned_rooms.setdefault(room_id, OwnedRoom(room_id=room_id, room_version=ROOM_VERSION, room_type=template.room_type, admins=[sender], name=name))
+        await self.update_owned_room(room_id, creator=sender, visibility=self.get_visibility(JoinRulesStateEventContent.deserialize(join_rules)))
+        return room_id
 
     @command.new(help=f"Upgrade a room to version {ROOM_VERSION} (only for room admins).")
     @command.argument("room_id", label="Room ID", required=False)
+    @instrumented
     async def upgraderoom(self, evt: MessageEvent, room_id: str) -> None:
-        room_id = self.parse_args(evt.content, evt.room_id, extract_user_id=False)
+        try:
+            room_id = await self.parse_args(evt.content, evt.room_id, extract_user_id=False)
+        except Exception as e:
+            await evt.reply(e.args[0], allow_html=True)
+            return
 
         # Check if the room exists and can be upgraded
         try:
-            create_event = await self.client.get_state_event(room_id, EventType.ROOM_CREATE, "")
-            if create_event.type != None:
-                await evt.reply(f"The room {self.mention_mxid(room_id)} is a space. I can only upgrade rooms, not spaces.", allow_html=True)
-                return
-            if int(create_event.room_version) >= int(ROOM_VERSION):
-                await evt.reply(f"The room {self.mention_mxid(room_id)} is already on version {create_event.room_version}. I currently uses room version {ROOM_VERSION}.", allow_html=True)
-                return
+            create_event, tombstone_event = await self.get_room_state_events(room_id, EventType.ROOM_CREATE, EventType.ROOM_TOMBSTONE)
+            if create_event is None:
+                raise Exception("The room has no create event.")
         except Exception:
             await evt.reply(f"The room {self.mention_mxid(room_id)} does not exist or I am not a member of it.", allow_html=True)
             return
+        if create_event.content.type != None:
+            await evt.reply(f"The room {self.mention_mxid(room_id)} is a space. I can only upgrade rooms, not spaces.", allow_html=True)
+            return
+        # Unstable room versions like org.matrix.msc2176 cannot be compared with ROOM_VERSION
+        if not create_event.content.room_version.isdigit():
+            await evt.reply(f"The room {self.mention_mxid(room_id)} uses the unknown room version {create_event.content.room_version} and cannot be upgraded.", allow_html=True)
+            return
+        if int(create_event.content.room_version) >= int(ROOM_VERSION):
+            await evt.reply(f"The room {self.mention_mxid(room_id)} is already on version {create_event.content.room_version}. I currently uses room version {ROOM_VERSION}.", allow_html=True)
+            return
         
         # Check if the room has not yet been upgraded
-        try:
-            await self.client.get_state_event(room_id, EventType.ROOM_TOMBSTONE, "")
+        if tombstone_event is not None:
             await evt.reply(f"The room {self.mention_mxid(room_id)} has already been upgraded once and cannot be upgraded again.", allow_html=True)
             return
-        except Exception:
-            pass
         
         # Check that the user is an admin in the room
         try:
@@ -161,36 +736,70 @@ class RoomManager(Plugin):
 
         try:
             new_room_id = (await self.client.api.request(Method.POST, Path.v3.rooms[room_id].upgrade, {"new_version": ROOM_VERSION}))["replacement_room"]
-            members = [m.state_key for m in await self.client.get_members(room_id) if m.content.membership in [Membership.JOIN, Membership.INVITE]]
-            for member in [m for m in members if not m == self.client.mxid]:
-                await self.client.invite_user(new_room_id, member)
-            if not self.config["silence_success_responses"] or not await self.is_group_chat(evt.room_id):
-                await evt.reply(f"Room {self.mention_mxid(room_id)} has been upgraded to v{ROOM_VERSION}.", allow_html=True)
-            await self.log_event(EVENT_TYPE_ROOM_CHANGE, f"{self.mention_mxid(evt.sender)} upgraded the room {self.mention_mxid(room_id)} to version {ROOM_VERSION}.")
         except Exception:
             await evt.reply(f"Could not upgrade the room {self.mention_mxid(room_id)}. Make sure I have sufficient permissions.", allow_html=True)
+            return
+        self.owned_rooms.setdefault(new_room_id, OwnedRoom(room_id=new_room_id, room_version=ROOM_VERSION))
+        await self.update_owned_room(new_room_id, creator=evt.sender, predecessor=room_id)
+        silent = self.config["silence_success_responses"] and await self.is_group_chat(evt.room_id)
+        if not silent:
+            await evt.reply(f"Room {self.mention_mxid(room_id)} has been upgraded to v{ROOM_VERSION}. I am inviting all members into the new room {self.mention_mxid(new_room_id)} now.", allow_html=True)
+        await self.log_event(EVENT_TYPE_ROOM_CHANGE, f"{self.mention_mxid(evt.sender)} upgraded the room {self.mention_mxid(room_id)} to version {ROOM_VERSION}.")
+        # Inviting the members of large rooms takes a while, so it continues in the background
+        self.sched.run_later(0, self.reinvite_members(evt, room_id, new_room_id, silent))
+
+    @instrumented
+    async def reinvite_members(self, evt: MessageEvent, room_id: RoomID, new_room_id: RoomID, silent: bool) -> None:
+        """Invites all joined and invited members of an upgraded room into its replacement room.
+        Posts progress after every batch and a final summary that lists the invites that failed.
+        """
+        try:
+            members = [m.state_key for m in await self.client.get_members(room_id) if m.content.membership in [Membership.JOIN, Membership.INVITE] and m.state_key != self.client.mxid]
+        except Exception:
+            await evt.reply(f"Could not load the members of {self.mention_mxid(room_id)}. Nobody has been invited into the new room {self.mention_mxid(new_room_id)}.", allow_html=True)
+            return
+        failed: dict[UserID, Exception] = {}
+        for start in range(0, len(members), UPGRADE_INVITE_BATCH_SIZE):
+            batch = members[start:start + UPGRADE_INVITE_BATCH_SIZE]
+            results = await self.gather_limited(lambda member: self.client.invite_user(new_room_id, member), batch)
+            failed.update({member: result for member, result in zip(batch, results) if isinstance(result, Exception)})
+            done = start + len(batch)
+            if not silent and done < len(members):
+                await evt.reply(f"Invited {done - len(failed)} of {len(members)} members into {self.mention_mxid(new_room_id)} so far.", allow_html=True)
+        if len(failed) > 0:
+            failed_mentions = [f"{self.mention_mxid(member)} ({e.args[0] if e.args else type(e).__name__})" for member, e in failed.items()]
+            await evt.reply(f"Invited {len(members) - len(failed)} of {len(members)} members into {self.mention_mxid(new_room_id)}. The following invites failed:<br>" + "<br>".join(failed_mentions), allow_html=True)
+        elif not silent:
+            await evt.reply(f"Invited all {len(members)} members into {self.mention_mxid(new_room_id)}.", allow_html=True)
 
     @command.new(help="Forget an empty room (only for instance admins).")
     @command.argument("room_id", label="Room ID", required=False)
+    @instrumented
     async def forgetroom(self, evt: MessageEvent, room_id: str) -> None:
-        room_id = self.parse_args(evt.content, evt.room_id, extract_user_id=False)
+        try:
+            room_id = await self.parse_args(evt.content, evt.room_id, extract_user_id=False)
+        except Exception as e:
+            await evt.reply(e.args[0], allow_html=True)
+            return
         
         if not evt.sender in self.config["administrators"]:
             await evt.reply("Only instance administrators can use this command. You can manage instance administrators via the maubot Web UI.", allow_html=True)
             return
 
-        create_event = [e for e in await self.client.get_state(room_id) if e.type == EventType.ROOM_CREATE]
-        if len(create_event) == 0:
+        try:
+            create_event = await self.get_room_state_event(room_id, EventType.ROOM_CREATE)
+        except MatrixRequestError:
+            create_event = None
+        if create_event is None:
             await evt.reply(f"The room {self.mention_mxid(room_id)} does not exist or I am not a member of it.", allow_html=True)
             return
-        if create_event[0].sender != self.client.mxid:
+        if create_event.sender != self.client.mxid:
             await self.client.leave_room(room_id)
             await self.client.forget_room(room_id)
             await evt.reply(f"I left the room {self.mention_mxid(room_id)} since I am not the owner.", allow_html=True)
             return
         
-        members = [m for m in await self.client.get_members(room_id) if m.content.membership == Membership.JOIN]
-        if len(members) > 1:
+        if await self.get_joined_member_count(room_id) > 1:
             await evt.reply(f"The room {self.mention_mxid(room_id)} is not empty. Only empty rooms can be forgotten.", allow_html=True)
             return
         await self.client.leave_room(room_id)
@@ -200,10 +809,10 @@ class RoomManager(Plugin):
     @command.new(help="Add another administrator to a given room (only for existing room admins).")
     @command.argument("user_id", label="User ID", required=True)
     @command.argument("room_id", label="Room ID", required=False)
+    @instrumented
     async def addadmin(self, evt: MessageEvent, user_id: str, room_id: str) -> None:
-        room_id, user_id = self.parse_args(evt.content, evt.room_id)
-
         try:
+            room_id, user_id = await self.parse_args(evt.content, evt.room_id)
             room_members, power_levels = await self.get_room_members(room_id)
             await self.assert_room_version(room_id)
             await self.assert_room_admin(room_members, power_levels, evt.sender)
@@ -223,6 +832,7 @@ class RoomManager(Plugin):
             if power_levels.get_user_level(user_id) < 100:
                 power_levels.set_user_level(user_id, 100)
                 await self.client.send_state_event(room_id, EventType.ROOM_POWER_LEVELS, power_levels)
+                self.state_cache.pop((room_id, EventType.ROOM_POWER_LEVELS, ""))
 
             if not self.config["silence_success_responses"] or not await self.is_group_chat(evt.room_id):
                 await evt.reply(f"User {self.mention_mxid(user_id)} has been promoted to administrator in room {self.mention_mxid(room_id)}.", allow_html=True)
@@ -234,11 +844,11 @@ class RoomManager(Plugin):
     @command.new(help="Demotes a room administrator to normal user (only for room admins).")
     @command.argument("user_id", label="User ID", required=True)
     @command.argument("room_id", label="Room ID", required=False)
+    @instrumented
     async def removeadmin(self, evt: MessageEvent, user_id: str, room_id: str) -> None:
-        room_id, user_id = self.parse_args(evt.content, evt.room_id)
-        self.log.info(f"Demoting user {user_id} in room {room_id}")
-
         try:
+            room_id, user_id = await self.parse_args(evt.content, evt.room_id)
+            self.log.info(f"Demoting user {user_id} in room {room_id}")
             room_members, power_levels = await self.get_room_members(room_id)
             await self.assert_room_version(room_id)
             await self.assert_room_admin(room_members, power_levels, evt.sender)
@@ -255,6 +865,7 @@ class RoomManager(Plugin):
             if power_levels.get_user_level(user_id) == 100:
                 power_levels.set_user_level(user_id, 0)
                 await self.client.send_state_event(room_id, EventType.ROOM_POWER_LEVELS, power_levels)
+                self.state_cache.pop((room_id, EventType.ROOM_POWER_LEVELS, ""))
 
             if not self.config["silence_success_responses"] or not await self.is_group_chat(evt.room_id):
                 await evt.reply(f"User {self.mention_mxid(user_id)} has been demoted from administrator in room {self.mention_mxid(room_id)}.", allow_html=True)
@@ -265,10 +876,10 @@ class RoomManager(Plugin):
 
     @command.new(help="Promote yourself to a room administrator (only for instance admins).")
     @command.argument("room_id", label="Room ID", required=False)
+    @instrumented
     async def becomeadmin(self, evt: MessageEvent, room_id: str) -> None:
-        room_id = self.parse_args(evt.content, evt.room_id, extract_user_id=False)
-
         try:
+            room_id = await self.parse_args(evt.content, evt.room_id, extract_user_id=False)
             room_members, power_levels = await self.get_room_members(room_id)
             await self.assert_room_version(room_id)
 
@@ -284,6 +895,7 @@ class RoomManager(Plugin):
             if power_levels.get_user_level(evt.sender) < 100:
                 power_levels.set_user_level(evt.sender, 100)
                 await self.client.send_state_event(room_id, EventType.ROOM_POWER_LEVELS, power_levels)
+                self.state_cache.pop((room_id, EventType.ROOM_POWER_LEVELS, ""))
 
             if not self.config["silence_success_responses"] or not await self.is_group_chat(evt.room_id):
                 await evt.reply(f"You have been promoted to administrator in room {self.mention_mxid(room_id)}.", allow_html=True)
@@ -292,64 +904,401 @@ class RoomManager(Plugin):
             await evt.reply(e.args[0], allow_html=True)
             return
 
-    def parse_args(self, content: TextMessageEventContent, room_id: RoomID, extract_user_id: bool = True) -> str | tuple[str, str]:
+    @command.new(help="Promote several users to administrators in several rooms or all rooms of a space (only for room admins).")
+    @command.argument("targets", label="User IDs... Room IDs or Space ID...", pass_raw=True, required=True)
+    @instrumented
+    async def bulkaddadmin(self, evt: MessageEvent, targets: str) -> None:
+        user_ids, room_ids = await self.parse_bulk_args(evt.content)
+        await self._bulkchangeadmins(evt, user_ids, room_ids, 100)
+
+    @command.new(help="Demote several room administrators in several rooms or all rooms of a space (only for room admins).")
+    @command.argument("targets", label="User IDs... Room IDs or Space ID...", pass_raw=True, required=True)
+    @instrumented
+    async def bulkremoveadmin(self, evt: MessageEvent, targets: str) -> None:
+        user_ids, room_ids = await self.parse_bulk_args(evt.content)
+        await self._bulkchangeadmins(evt, user_ids, room_ids, 0)
+
+    @command.new(help="Promote yourself to an administrator in several rooms or all rooms of a space (only for instance admins).")
+    @command.argument("targets", label="Room IDs or Space ID...", pass_raw=True, required=True)
+    @instrumented
+    async def bulkbecomeadmin(self, evt: MessageEvent, targets: str) -> None:
+        _, room_ids = await self.parse_bulk_args(evt.content)
+        if not evt.sender in self.config["administrators"]:
+            await evt.reply("Only instance administrators can use this command. You can manage instance administrators via the maubot Web UI.", allow_html=True)
+            return
+        await self._bulkchangeadmins(evt, [evt.sender], room_ids, 100, assert_admin=False)
+
+    async def _bulkchangeadmins(self, evt: MessageEvent, user_ids: list[str], room_ids: list[str], level: int, assert_admin: bool = True) -> None:
+        if len(user_ids) == 0 or len(room_ids) == 0:
+            await evt.reply("Please provide at least one user ID and one room ID or space ID.")
+            return
+        # Spaces are expanded to the space itself and all of its child rooms
+        expanded_room_ids = list(dict.fromkeys(room_ids))
+        for child_room_ids in await self.gather_limited(self.expand_space, room_ids):
+            if not isinstance(child_room_ids, Exception):
+                expanded_room_ids += [r for r in child_room_ids if r not in expanded_room_ids]
+
+        results = await self.gather_limited(lambda room_id: self.change_admins(evt.sender, room_id, user_ids, level, assert_admin), expanded_room_ids)
+        action = "promoted to administrator" if level == 100 else "demoted from administrator"
+        failed_lines, changed_lines, unchanged_lines = [], [], []
+        # Rooms in which some users were changed are logged, even if other users could not be invited
+        logged_lines = []
+        for room_id, result in zip(expanded_room_ids, results):
+            if isinstance(result, Exception):
+                failed_lines.append(f"{self.mention_mxid(room_id)}: {result.args[0] if result.args else type(result).__name__}")
+                continue
+            changed_user_ids, failed_user_ids = result
+            parts = [f"{action} " + ", ".join(self.mention_mxid(u) for u in changed_user_ids)] if len(changed_user_ids) > 0 else []
+            if len(failed_user_ids) > 0:
+                parts.append("could not find or invite " + ", ".join(self.mention_mxid(u) for u in failed_user_ids))
+            line = f"{self.mention_mxid(room_id)}: " + ("; ".join(parts) if len(parts) > 0 else "no changes necessary")
+            if len(changed_user_ids) > 0:
+                logged_lines.append(line)
+            if len(failed_user_ids) > 0:
+                failed_lines.append(line)
+            elif len(changed_user_ids) > 0:
+                changed_lines.append(line)
+            else:
+                unchanged_lines.append(line)
+        message = f"Changed administrators in {len(logged_lines)} of {len(results)} rooms"
+        if len(unchanged_lines) > 0:
+            message += f", {len(unchanged_lines)} rooms needed no changes"
+        if len(failed_lines) > 0:
+            message += f", {len(failed_lines)} rooms failed completely or partially"
+        if len(failed_lines) > 0 or not self.config["silence_success_responses"] or not await self.is_group_chat(evt.room_id):
+            # Failures are listed first, since long lists are shortened to stay within the event size limit
+            await evt.reply(message + ":<br>" + self.shorten_lines(failed_lines + changed_lines + unchanged_lines), allow_html=True)
+        if len(logged_lines) > 0:
+            await self.log_event(EVENT_TYPE_PERMISSION_CHANGE, f"{self.mention_mxid(evt.sender)} changed administrators in {len(logged_lines)} rooms:<br>" + self.shorten_lines(logged_lines))
+
+    def shorten_lines(self, lines: list[str]) -> str:
+        """Joins at most listrooms_page_size lines and replaces the rest with a count."""
+        limit = self.config["listrooms_page_size"]
+        if len(lines) > limit:
+            lines = lines[:limit] + [f"and {len(lines) - limit} more"]
+        return "<br>".join(lines)
+
+    async def expand_space(self, room_id: str) -> list[RoomID]:
+        """Returns the IDs of all child rooms if the room is a space, or an empty list otherwise."""
+        create_event = await self.get_room_state_event(room_id, EventType.ROOM_CREATE)
+        if create_event is None or create_event.content.type != RoomType.SPACE:
+            return []
+        # The first room of the hierarchy is the space itself, its children_state holds the m.space.child events,
+        # so the children are known without loading the full state of the space
+        hierarchy = await self.client.api.request(Method.GET, Path.v1.rooms[room_id].hierarchy, query_params={"max_depth": "1", "limit": "1"})
+        children_state = hierarchy["rooms"][0].get("children_state", []) if len(hierarchy.get("rooms", [])) > 0 else []
+        # Removed children keep their m.space.child event, but without the via list
+        return [e["state_key"] for e in children_state if e.get("type") == EventType.SPACE_CHILD.t and e.get("content", {}).get("via")]
+
+    async def change_admins(self, sender: UserID, room_id: str, user_ids: list[str], level: int, assert_admin: bool) -> tuple[list[str], list[str]]:
+        """Promotes (level 100) or demotes (level 0) all given users in the room with a single power levels event.
+        Returns the users whose power level was changed and the users who could not be invited.
+        """
+        room_members, power_levels = await self.get_room_members(room_id)
+        await self.assert_room_version(room_id)
+        if assert_admin:
+            await self.assert_room_admin(room_members, power_levels, sender)
+        changed_user_ids, failed_user_ids = [], []
+        for user_id in user_ids:
+            # The bot is the room creator and can neither be promoted nor demoted
+            if user_id == self.client.mxid:
+                continue
+            if level == 100:
+                if not user_id in room_members:
+                    # A failed invite only skips this user, the others are still promoted
+                    try:
+                        await self.retry_rate_limited(self.client.invite_user, room_id, user_id)
+                    except Exception:
+                        failed_user_ids.append(user_id)
+                        continue
+                if power_levels.get_user_level(user_id) < 100:
+                    power_levels.set_user_level(user_id, 100)
+                    changed_user_ids.append(user_id)
+            elif level == 0 and power_levels.get_user_level(user_id) == 100 and user_id in room_members:
+                power_levels.set_user_level(user_id, 0)
+                changed_user_ids.append(user_id)
+        if len(changed_user_ids) > 0:
+            await self.retry_rate_limited(self.client.send_state_event, room_id, EventType.ROOM_POWER_LEVELS, power_levels)
+            self.state_cache.pop((room_id, EventType.ROOM_POWER_LEVELS, ""))
+        return changed_user_ids, failed_user_ids
+
+    async def run_janitor(self) -> None:
+        """Runs the janitor every janitor_interval hours. The interval is read again after every run, 0 disables the janitor."""
+        while True:
+            interval = self.config["janitor_interval"]
+            # A disabled janitor checks once a minute whether it has been enabled in the meantime
+            await asyncio.sleep(interval * 3600 if interval > 0 else 60)
+            if interval > 0 and self.config["janitor_interval"] > 0:
+                try:
+                    await self.clean_rooms()
+                except Exception as e:
+                    self.log.warning(f"The janitor run failed: {e}")
+
+    @instrumented
+    async def clean_rooms(self) -> None:
+        """Finds owned rooms without members other than the bot or without activity for janitor_max_age days.
+        Depending on janitor_action they are only reported or left and forgotten in batches, then a summary is logged.
+        """
+        await self.room_index_task
+        max_age = self.config["janitor_max_age"]
+        cutoff = (time.time() - max_age * 86400) * 1000
+        # The logging channel may be an owned room that only the bot reads
+        rooms = [r for r in self.owned_rooms.values() if r.room_id != self.config["logging_channel"]]
+
+        async def inspect(room: OwnedRoom) -> str | None:
+            # New rooms and replacement rooms of upgrades only have invited members until the invites are accepted
+            if await self.get_joined_member_count(room.room_id) <= 1 and await self.get_invited_member_count(room.room_id) == 0:
+                return "empty"
+            if max_age > 0:
+                last_activity = await self.get_last_activity(room.room_id)
+                if last_activity is not None and last_activity < cutoff:
+                    return f"inactive for {int((time.time() * 1000 - last_activity) / 86400000)} days"
+            return None
+
+        results = await self.gather_limited(inspect, rooms, limit=self.config["janitor_max_parallel"])
+        found = [(room, reason) for room, reason in zip(rooms, results) if isinstance(reason, str)]
+        failed_checks = len([r for r in results if isinstance(r, Exception)])
+        forget = self.config["janitor_action"] == "forget" and not self.config["janitor_dry_run"]
+        forgotten, failed = [], []
+        if forget:
+            batch_size = max(1, self.config["janitor_batch_size"])
+            for start in range(0, len(found), batch_size):
+                batch = [room for room, _ in found[start:start + batch_size]]
+                for room, result in zip(batch, await self.gather_limited(self.leave_and_forget, batch, limit=self.config["janitor_max_parallel"])):
+                    (failed if isinstance(result, Exception) else forgotten).append(room)
+        self.log.info(f"Janitor checked {len(rooms)} rooms and found {len(found)} empty or inactive rooms, {len(forgotten)} were forgotten")
+        if len(found) == 0 and failed_checks == 0:
+            return
+
+        # Long lists are shortened, so the summary fits into a single message
+        limit = self.config["listrooms_page_size"]
+        room_lines = [f"{self.format_owned_room(room)}: {reason}" for room, reason in found[:limit]]
+        if len(found) > limit:
+            room_lines.append(f"and {len(found) - limit} more")
+        message = f"The janitor checked {len(rooms)} rooms and found {len(found)} empty or inactive rooms"
+        if failed_checks > 0:
+            message += f", {failed_checks} rooms could not be checked"
+        if forget:
+            message += f". I left and forgot {len(forgotten)} of them" + (f", {len(failed)} could not be forgotten" if len(failed) > 0 else "")
+        elif self.config["janitor_action"] == "forget":
+            message += ". This was a dry run, no room has been forgotten"
+        message += ":<br>" + "<br>".join(room_lines) if len(room_lines) > 0 else "."
+        await self.log_event(EVENT_TYPE_ROOM_CHANGE, message)
+
+    async def leave_and_forget(self, room: OwnedRoom) -> None:
+        await self.client.leave_room(room.room_id)
+        await self.client.forget_room(room.room_id)
+        await self.forget_owned_room(room.room_id)
+        self.member_counts.pop(room.room_id, None)
+        self.invited_counts.pop(room.room_id, None)
+        self.last_activity.pop(room.room_id, None)
+
+    @command.new(help="Show latency and homeserver usage statistics of the commands (only for instance admins).")
+    async def stats(self, evt: MessageEvent) -> None:
+        if not evt.sender in self.config["administrators"]:
+            await evt.reply("Only instance administrators can use this command. You can manage instance administrators via the maubot Web UI.", allow_html=True)
+            return
+        lines = []
+        for name, stats in sorted(self.operation_stats.items()):
+            cache_accesses = stats.cache_hits + stats.cache_misses
+            lines.append(
+                f"<b>{name}</b>: {stats.runs} runs, {stats.errors} errors, "
+                f"avg {stats.total_seconds / max(1, stats.runs):.3f} s, max {stats.max_seconds:.3f} s, "
+                f"{stats.requests / max(1, stats.runs):.1f} requests per run, {stats.bytes_received / 1024:.1f} KiB received, "
+                f"{stats.rate_limited} rate limited"
+                + (f", {stats.cache_hits} of {cache_accesses} cache hits" if cache_accesses > 0 else "")
+            )
+        lines.append(f"<b>State cache</b>: {len(self.state_cache.entries)} entries, {self.state_cache.hits} hits, {self.state_cache.misses} misses")
+        lines.append(f"<b>Alias cache</b>: {len(self.alias_cache.entries)} entries, {self.alias_cache.hits} hits, {self.alias_cache.misses} misses")
+        lines.append(f"<b>Logging channel</b>: {len(self.log_buffer)} entries queued, {self.log_dropped_total} entries dropped")
+        await evt.reply("<br>".join(lines), allow_html=True)
+
+    @web.get("/metrics")
+    async def metrics(self, request: Request) -> Response:
+        """Exposes the statistics of !stats in the Prometheus text format."""
+        metrics = [
+            ("roommanager_operation_runs_total", "counter", "Number of runs of a command or background operation.", lambda s: s.runs),
+            ("roommanager_operation_errors_total", "counter", "Number of runs that ended with an unhandled error.", lambda s: s.errors),
+            ("roommanager_operation_seconds_total", "counter", "Total wall time spent in a command or background operation.", lambda s: s.total_seconds),
+            ("roommanager_operation_seconds_max", "gauge", "Longest wall time of a single run.", lambda s: s.max_seconds),
+            ("roommanager_homeserver_requests_total", "counter", "Number of homeserver requests.", lambda s: s.requests),
+            ("roommanager_homeserver_rate_limited_total", "counter", "Number of homeserver requests rejected with 429 Too Many Requests.", lambda s: s.rate_limited),
+            ("roommanager_homeserver_received_bytes_total", "counter", "Number of bytes received from the homeserver.", lambda s: s.bytes_received),
+            ("roommanager_cache_hits_total", "counter", "Number of lookups answered from the state cache.", lambda s: s.cache_hits),
+            ("roommanager_cache_misses_total", "counter", "Number of lookups that had to query the homeserver.", lambda s: s.cache_misses),
+        ]
+        lines = []
+        for metric, metric_type, description, value in metrics:
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} {metric_type}"]
+            lines += [f'{metric}{{operation="{name}"}} {value(stats)}' for name, stats in sorted(self.operation_stats.items())]
+        lines += [
+            "# HELP roommanager_state_cache_entries Number of entries in the state cache.",
+            "# TYPE roommanager_state_cache_entries gauge",
+            f"roommanager_state_cache_entries {len(self.state_cache.entries)}",
+            "# HELP roommanager_alias_cache_entries Number of room aliases in the alias cache.",
+            "# TYPE roommanager_alias_cache_entries gauge",
+            f"roommanager_alias_cache_entries {len(self.alias_cache.entries)}",
+            "# HELP roommanager_log_buffer_entries Number of log entries waiting to be sent to the logging channel.",
+            "# TYPE roommanager_log_buffer_entries gauge",
+            f"roommanager_log_buffer_entries {len(self.log_buffer)}",
+            "# HELP roommanager_log_dropped_total Number of log entries dropped because the log buffer was full or the homeserver rejected them.",
+            "# TYPE roommanager_log_dropped_total counter",
+            f"roommanager_log_dropped_total {self.log_dropped_total}",
+        ]
+        return Response(text="\n".join(lines) + "\n", headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def parse_args(self, content: TextMessageEventContent, room_id: RoomID, extract_user_id: bool = True) -> RoomID | tuple[RoomID, str]:
         """Parses either room_id or room_id and user_id as arguments.
-        If a mention is used and represented as an HTML link, the full Matrix ID is extracted.
+        Mentions and matrix.to links are reduced to the full Matrix ID and room aliases are resolved to room IDs.
         """
-        command_raw = content.formatted_body if content.formatted_body else content.body
-        command_raw = command_raw.strip()
-        while command_raw.endswith("<br/>"):
-            command_raw = command_raw[:-5].strip()
-        # Mentioning a user can look like this: <a href="https://matrix.to/#/@user:server">@user</a>
-        # Only the html variant contains the full Matrix ID, since the plain text variant removes the a tag and only keeps @user
-        command_raw = re.sub(r'<a\s+href=[\'"]https?://matrix\.to/#/([^\'"]+)[\'"]>[^<]*</a>', r'\1', command_raw, flags=re.IGNORECASE)
+        args = parse_command_args(content)
         if extract_user_id:
-            args = command_raw.split()
-            #user_id = self.unpack_html_link("@", args[1])
-            #room_id = self.unpack_html_link("#|!", args[2]) if len(args) > 2 else room_id
-            return args[2] if len(args) > 2 else room_id, args[1]
+            room_arg = args[1] if len(args) > 1 else None
+            user_id = args[0].value if len(args) > 0 else ""
         else:
-            args = command_raw.split()
-            #room_id = self.unpack_html_link("#|!", args[1]) if len(args) > 1 else room_id
-            return args[1] if len(args) > 1 else room_id
-
-    def unpack_html_link(self, prefix_token: str, text: str) -> str:
-        # Mentioning a user can look like this: <a href="https://matrix.to/#/@user:server">@user</a>
-        # Only the html variant contains the full Matrix ID, since the plain text variant removes the a tag and only keeps @user
-        m = re.search(r'href=[\'"](https?://matrix\.to/#/(' + prefix_token + r'[^\'"]+))[\'"]', text)
-        if m:
-            return m.group(2)
-        return text.rstrip("<br/>").strip()
-    
+            room_arg = args[0] if len(args) > 0 else None
+        if room_arg is not None:
+            room_id = await self.resolve_room(room_arg.value) if room_arg.type == ArgumentType.ROOM_ALIAS else room_arg.value
+        return (room_id, user_id) if extract_user_id else room_id
+
+    async def parse_bulk_args(self, content: TextMessageEventContent) -> tuple[list[str], list[str]]:
+        """Parses any number of user IDs and room IDs (or aliases) as arguments, in any order.
+        Aliases that cannot be resolved are kept, so they are reported with the results of the other rooms.
+        """
+        args = parse_command_args(content)
+        aliases = list(dict.fromkeys(a.value for a in args if a.type == ArgumentType.ROOM_ALIAS))
+        resolved = dict(zip(aliases, await self.gather_limited(self.resolve_room, aliases)))
+        room_ids = [a.value if a.type == ArgumentType.ROOM_ID or isinstance(resolved[a.value], Exception) else resolved[a.value] for a in args if a.is_room]
+        return [a.value for a in args if a.type == ArgumentType.USER_ID], room_ids
+
+    async def resolve_room(self, room_alias: str) -> RoomID:
+        """Resolves a room alias to a room ID, using the alias cache if possible."""
+        room_id = self.alias_cache.get(room_alias)
+        self.record_cache_access(room_id is not None)
+        if room_id is None:
+            try:
+                room_id = (await self.client.resolve_room_alias(RoomAlias(room_alias))).room_id
+            except MatrixRequestError:
+                raise Exception(f"The room alias {room_alias} does not exist.")
+            self.alias_cache.put(room_alias, room_id, self.config["state_cache_ttl"])
+        return room_id
+
+    async def gather_limited(self, func: Callable[[T], Awaitable[R]], items: Iterable[T], limit: int | None = None) -> list[R | Exception]:
+        """Calls func for every item with at most limit (by default max_parallel_requests) homeserver requests in flight at the same time.
+        The limit counts requests rather than calls, since a single call can send several requests. Nested calls share the limit of the outermost one.
+        The results are returned in the order of the items. Failed calls return their exception instead of a result.
+        """
+
+        async def run(item: T) -> R | Exception:
+            try:
+                return await self.retry_rate_limited(func, item)
+            except Exception as e:
+                return e
+
+        # The tasks created by gather copy the context, so all requests they send wait for the same semaphore
+        token = None
+        if self.request_limit.get() is None:
+            token = self.request_limit.set(asyncio.Semaphore(max(1, limit if limit is not None else self.config["max_parallel_requests"])))
+        try:
+            return await asyncio.gather(*[run(item) for item in items])
+        finally:
+            if token is not None:
+                self.request_limit.reset(token)
+
+    async def retry_rate_limited(self, func: Callable[..., Awaitable[R]], *args) -> R:
+        """Calls func and retries with an exponential backoff if the homeserver responds with 429 Too Many Requests."""
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                return await func(*args)
+            except MatrixRequestError as e:
+                if e.http_status != 429 or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                # mautrix does not keep the retry_after_ms field of M_LIMIT_EXCEEDED errors, so back off exponentially
+                delay = RATE_LIMIT_BACKOFF * 2 ** attempt
+                self.log.debug(f"Rate limited by the homeserver, retrying in {delay} seconds")
+                await asyncio.sleep(delay)
+
     def mention_mxid(self, mxid: str) -> str:
         return f'<a href="https://matrix.to/#/{mxid}">{mxid}</a>'
     
     async def is_group_chat(self, room_id: str) -> bool:
         """Returns True if the room is a group chat (more than 2 members), False otherwise."""
         try:
-            members = [m.state_key for m in await self.client.get_members(room_id) if m.content.membership == Membership.JOIN]
-            return len(members) > 2
+            return await self.get_joined_member_count(room_id) > 2
         except Exception:
             return False
-        
-    async def get_room_name(self, room_id: str) -> str:
-        """Returns the room name for the given room ID."""
-        try:
-            room_state = await self.client.get_state(room_id)
-            name_event = [e for e in room_state if e.type == EventType.ROOM_NAME]
-            alias_event = [e for e in room_state if e.type == EventType.ROOM_CANONICAL_ALIAS]
-            if len(name_event) > 0 and name_event[0].content.name:
-                return name_event[0].content.name
-            elif len(alias_event) > 0 and alias_event[0].content.canonical_alias:
-                return alias_event[0].content.canonical_alias
-            else:
-                return "Unnamed Room"
-        except Exception:
-            return "Unknown Room"
+
+    async def get_joined_member_count(self, room_id: str) -> int:
+        """Returns the number of joined members of the room without loading the full member list if possible."""
+        member_count = self.member_counts.get(room_id)
+        self.record_cache_access(member_count is not None)
+        if member_count is None:
+            member_count = len(await self.client.get_joined_members(room_id))
+            self.member_counts[room_id] = member_count
+        return member_count
+
+    async def get_invited_member_count(self, room_id: str) -> int:
+        """Returns the number of invited members of the room, only loading the invites if the count is not known from sync."""
+        invited_count = self.invited_counts.get(room_id)
+        self.record_cache_access(invited_count is not None)
+        if invited_count is None:
+            invited_count = len(await self.client.get_members(room_id, membership=Membership.INVITE))
+            self.invited_counts[room_id] = invited_count
+        return invited_count
+
+    async def get_last_activity(self, room_id: str) -> int | None:
+        """Returns the timestamp of the latest event in the room in milliseconds, or None if the room has no visible events."""
+        last_activity = self.last_activity.get(room_id)
+        self.record_cache_access(last_activity is not None)
+        if last_activity is None:
+            messages = await self.client.get_messages(room_id, PaginationDirection.BACKWARD, limit=1)
+            if len(messages.events) == 0:
+                return None
+            last_activity = self.last_activity[room_id] = messages.events[0].timestamp
+        return last_activity
+
+    async def get_room_state_event(self, room_id: str, event_type: EventType, state_key: str = "") -> StateEvent | None:
+        """Returns a single state event of the room, or None if the room has no such state event.
+        Only the requested event is fetched from the homeserver and the result is stored in the state cache.
+        """
+        key = (room_id, event_type, state_key)
+        state_event = self.state_cache.get(key)
+        self.record_cache_access(state_event is not None)
+        if state_event is None:
+            try:
+                state_event = await self.client.get_state_event(room_id, event_type, state_key, format="event")
+            except MNotFound:
+                state_event = STATE_NOT_FOUND
+            # The create event can never change, so it does not need to expire
+            self.state_cache.put(key, state_event, None if event_type == EventType.ROOM_CREATE else self.config["state_cache_ttl"])
+        return None if state_event is STATE_NOT_FOUND else state_event
+
+    async def get_room_state_events(self, room_id: str, *event_types: EventType) -> list[StateEvent | None]:
+        """Looks up the state events with an empty state key of all given types concurrently."""
+        return await asyncio.gather(*[self.get_room_state_event(room_id, event_type) for event_type in event_types])
+
+    async def get_joined_members(self, room_id: str) -> list[UserID]:
+        """Returns the user IDs of all joined members of the room, using the state cache if possible."""
+        key = (room_id, EventType.ROOM_MEMBER, None)
+        members = self.state_cache.get(key)
+        self.record_cache_access(members is not None)
+        if members is None:
+            members = [m.state_key for m in await self.client.get_members(room_id) if m.content.membership == Membership.JOIN]
+            self.state_cache.put(key, members, self.config["state_cache_ttl"])
+        return members
 
     async def assert_room_version(self, room_id: str) -> None:
         """Asserts that the room is of the supported ROOM_VERSION and was created by the bot itself."""
-        room_creation_event = [e for e in await self.client.get_state(room_id) if e.type == EventType.ROOM_CREATE][0]
+        # Rooms in the registry are owned by the bot, only unknown rooms need to be checked on the homeserver
+        await self.room_index_task
+        owned_room = self.owned_rooms.get(room_id)
+        if owned_room is not None:
+            if owned_room.room_version != ROOM_VERSION:
+                raise Exception(f"I only support rooms with version {ROOM_VERSION}. The room {self.mention_mxid(room_id)} has version {owned_room.room_version}.")
+            return
+        room_creation_event = await self.get_room_state_event(room_id, EventType.ROOM_CREATE)
+        if room_creation_event is None:
+            raise Exception(f"The room {self.mention_mxid(room_id)} does not exist or I am not a member of it.")
         if room_creation_event.content.room_version != ROOM_VERSION:
             raise Exception(f"I only support rooms with version {ROOM_VERSION}. The room {self.mention_mxid(room_id)} has version {room_creation_event.content.room_version}.")
         if room_creation_event.sender != self.client.mxid:
@@ -365,25 +1314,86 @@ class RoomManager(Plugin):
     async def get_room_members(self, room_id: str) -> tuple[list[str], PowerLevelStateEventContent]:
         """Returns the list of room members and the power levels dict for the given room."""
         try:
-            room_members = [m.state_key for m in await self.client.get_members(room_id) if m.content.membership == Membership.JOIN]
-            power_levels = await self.client.get_state_event(room_id, EventType.ROOM_POWER_LEVELS, "")
+            room_members, power_levels_event = await asyncio.gather(
+                self.get_joined_members(room_id),
+                self.get_room_state_event(room_id, EventType.ROOM_POWER_LEVELS)
+            )
+            # Callers modify the power levels before sending them, so they must not change the cached event
+            power_levels = PowerLevelStateEventContent.deserialize(power_levels_event.content.serialize())
             return room_members, power_levels
+        except MatrixRequestError as e:
+            # Rate limits are passed on unchanged, so retry_rate_limited can retry the room
+            if e.http_status == 429:
+                raise
+            raise Exception(f"The room {self.mention_mxid(room_id)} does not exist or I am not a member of it.")
         except Exception:
             raise Exception(f"The room {self.mention_mxid(room_id)} does not exist or I am not a member of it.")
     
     def strip_html_tags(self, text: str) -> str:
-        return re.sub(re.compile('<.*?>'), '', text.replace('<br>', '\n'))
+        return HTML_TAG.sub("", text.replace("<br>", "\n"))
 
     async def log_event(self, event_type: str, message: str) -> None:
-        """Logs an event to the logging channel if configured."""
+        """Logs an event to the logging channel if configured.
+        The message is only queued here, the log writer sends queued messages in batches in the background.
+        """
         if self.config["logging_channel"] and event_type in self.config["logging_events"]:
-            await self.client.send_message(
-                self.config["logging_channel"],
-                TextMessageEventContent(
+            if len(self.log_buffer) >= self.config["logging_buffer_size"]:
+                self.log_dropped += 1
+                self.log_dropped_total += 1
+                return
+            self.log_buffer.append(message)
+            if len(self.log_buffer) >= self.config["logging_batch_size"]:
+                self.log_flush_requested.set()
+
+    async def run_log_writer(self) -> None:
+        """Flushes the log buffer every logging_flush_interval seconds or as soon as a full batch is queued."""
+        while True:
+            try:
+                await asyncio.wait_for(self.log_flush_requested.wait(), timeout=self.config["logging_flush_interval"])
+            except asyncio.TimeoutError:
+                pass
+            self.log_flush_requested.clear()
+            try:
+                await self.flush_log()
+            except Exception as e:
+                self.log.warning(f"Could not deliver log entries ({e}), {len(self.log_buffer)} entries are kept for the next attempt")
+
+    @instrumented
+    async def flush_log(self, retry: bool = True) -> None:
+        """Sends all buffered log entries to the logging channel, with up to logging_batch_size entries per message.
+        Entries are only removed from the buffer after they have been sent, so concurrent flushes are serialized.
+        """
+        async with self.log_flush_lock:
+            while len(self.log_buffer) > 0 or self.log_dropped > 0:
+                batch = [self.log_buffer[i] for i in range(min(len(self.log_buffer), self.config["logging_batch_size"]))]
+                dropped = self.log_dropped
+                if dropped > 0:
+                    batch.append(f"{dropped} log entries were dropped because they could not be delivered to the logging channel.")
+                message = "<br>".join(batch)
+                content = TextMessageEventContent(
                     msgtype=MessageType.TEXT,
                     body=self.strip_html_tags(message),
                     format="org.matrix.custom.html",
                     formatted_body=message
                 )
-            )
+                entry_count = len(batch) - (1 if dropped > 0 else 0)
+                try:
+                    if retry:
+                        await self.retry_rate_limited(self.client.send_message, self.config["logging_channel"], content)
+                    else:
+                        await self.client.send_message(self.config["logging_channel"], content)
+                except MatrixRequestError as e:
+                    # Rate limits are retried by the next flush, but a batch the homeserver rejects (e.g. M_TOO_LARGE)
+                    # would be rejected again and block all later entries, so it is dropped and only counted
+                    if e.http_status == 429 or entry_count == 0:
+                        raise
+                    self.log.warning(f"The homeserver rejected {entry_count} log entries ({e}), they are dropped")
+                    for _ in range(entry_count):
+                        self.log_buffer.popleft()
+                    self.log_dropped += entry_count
+                    self.log_dropped_total += entry_count
+                    continue
+                for _ in range(entry_count):
+                    self.log_buffer.popleft()
+                self.log_dropped -= dropped
         
\ No newline at end of file